@@ -1,15 +1,179 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import functools
+import itertools
 import json
-import requests
+import logging
+import math
+import queue
+import httpx
+import orjson
+import re
 import sys
 import base64
 import os
+import time
+from email.utils import parsedate_to_datetime
+from logging.handlers import QueueHandler, QueueListener
+from tqdm import tqdm
 
 
+logger = logging.getLogger("auth0_user_creator")
+
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=50)
+
+RETRY_TOTAL = 8
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_BACKOFF_MAX = 60
+# Rate limits and server errors are transient; any other error status is permanent
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Failures that mean the request was never processed. Only these are retried
+# for POST /users, where a repeated request after a success would get a 409
+UNPROCESSED_STATUSES = {429}
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+USER_CONNECTION = "Username-Password-Authentication"
+# Fields sent with every new user; only the email varies
+STATIC_USER_DATA = {
+    "connection": USER_CONNECTION,
+    "password": "Temp1234!",  # Temporary password
+    "email_verified": True
+}
+# Fixed parts of the mock POST /users response used in debug mode
+MOCK_USER_FIELDS = {
+    "email_verified": True,
+    "created_at": "2023-01-01T00:00:00.000Z",
+    "updated_at": "2023-01-01T00:00:00.000Z"
+}
+MOCK_IDENTITY_FIELDS = {
+    "provider": "auth0",
+    "isSocial": False
+}
+
+# Maximum number of users accepted by POST /roles/{id}/users
+ROLE_ASSIGNMENT_CHUNK_SIZE = 50
+# Seconds to wait for more users before assigning the role to a partial chunk
+ROLE_ASSIGNMENT_WAIT = 0.1
+# Created users waiting for role assignment before user creation pauses
+USER_QUEUE_SIZE = 200
+ROLE_STAGE_STOPPED_ERROR = "Role assignment stopped after an unexpected error"
+
+# Email placeholder: {$} or {$:<format spec>}, e.g. {$:04d}
+TEMPLATE_RE = re.compile(r"\{\$(?::(?P<fmt>[^}]+))?\}")
+
+
+class TqdmLoggingHandler(logging.Handler):
+    """Log handler that writes above the progress bar instead of through it."""
+    
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(verbose=False, debug=False):
+    """Route log records through a queue to a background writer thread.
+    
+    Workers only enqueue records, so terminal output never blocks them.
+    Returns the started listener, which must be stopped to flush the queue.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = TqdmLoggingHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler)
+    
+    logger.addHandler(QueueHandler(log_queue))
+    logger.propagate = False
+    # Per-user messages are INFO, request dumps are DEBUG
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    elif verbose:
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.WARNING)
+    
+    listener.start()
+    return listener
+
+
+def make_client(auth0_token, api_url):
+    """Create the HTTP/2 client shared by all API calls.
+    
+    Requests are made relative to api_url, e.g. client.post("users").
+    """
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS)
+    headers = {
+        "Authorization": f"Bearer {auth0_token}",
+        "Content-Type": "application/json"
+    }
+    return httpx.AsyncClient(transport=transport, headers=headers, base_url=api_url)
+
+
+def get_retry_delay(response, attempt):
+    """Seconds to wait before retrying, honoring the Retry-After header if present.
+    
+    The wait is capped at RETRY_BACKOFF_MAX either way.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        # Retry-After is either a number of seconds or an HTTP date
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        
+        # Ignore nonsense values and never wait longer than the backoff cap
+        if delay is not None and math.isfinite(delay):
+            return min(max(delay, 0), RETRY_BACKOFF_MAX)
+    
+    return min(RETRY_BACKOFF_FACTOR * (2 ** attempt), RETRY_BACKOFF_MAX)
+
+
+def describe_failure(action, response, idempotent=True):
+    """Build the error message for a failed API call."""
+    retry_statuses = RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES
+    if response.status_code in retry_statuses:
+        return f"Failed to {action} after {RETRY_TOTAL} retries: {response.text}"
+    return f"Failed to {action}: {response.text}"
+
+
+async def send_with_retry(client, method, url, idempotent=True, **kwargs):
+    """Send a request, retrying transient failures.
+    
+    Transient statuses and connection errors are retried with exponential
+    backoff, or after Retry-After when the API sends it. Permanent failures
+    are returned right away; transient ones once the retries are used up.
+    
+    Requests that are not idempotent are only retried when they were never
+    processed, i.e. on a rate limit or when the connection failed.
+    """
+    retry_statuses = RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES
+    for attempt in range(RETRY_TOTAL + 1):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == RETRY_TOTAL or not (idempotent or isinstance(e, UNSENT_ERRORS)):
+                raise
+            await asyncio.sleep(get_retry_delay(None, attempt))
+            continue
+        
+        if response.status_code not in retry_statuses or attempt == RETRY_TOTAL:
+            return response
+        await asyncio.sleep(get_retry_delay(response, attempt))
+
+
+@functools.lru_cache(maxsize=8)
 def decode_jwt_payload(token):
-    """Decode the payload part of a JWT token."""
+    """Decode the payload part of a JWT token.
+    
+    The result is cached per token string, so callers must not mutate it.
+    """
     parts = token.split('.')
     if len(parts) != 3:
         print("Error: Invalid JWT token format")
@@ -46,19 +210,12 @@ def extract_api_url_from_token(token):
     return aud
 
 
-def get_roles(auth0_token, api_url, debug=False):
+async def get_roles(client, debug=False):
     """Fetch all roles from Auth0."""
-    headers = {
-        "Authorization": f"Bearer {auth0_token}",
-        "Content-Type": "application/json"
-    }
-    
-    roles_url = f"{api_url}roles"
-    
     if debug:
         print("\n=== DEBUG: Roles Fetch Request ===")
-        print(f"URL: {roles_url}")
-        print(f"Headers: {json.dumps(headers, indent=2)}")
+        print(f"URL: {client.base_url}roles")
+        print(f"Headers: {json.dumps(dict(client.headers), indent=2)}")
         # Mock a successful response for debug mode
         mock_roles = [
             {"id": "rol_1", "name": "Admin", "description": "Administrator role"},
@@ -68,13 +225,13 @@ def get_roles(auth0_token, api_url, debug=False):
         print(f"Mock Response: {json.dumps(mock_roles, indent=2)}")
         return mock_roles
     else:
-        roles_response = requests.get(roles_url, headers=headers)
+        roles_response = await send_with_retry(client, "GET", "roles")
         
         if roles_response.status_code != 200:
             print(f"Failed to fetch roles: {roles_response.text}")
             sys.exit(1)
         
-        return roles_response.json()
+        return orjson.loads(roles_response.content)
 
 
 def prompt_role_selection(roles):
@@ -100,139 +257,208 @@ def prompt_role_selection(roles):
             print("Please enter a valid number.")
 
 
-def create_user(auth0_token, email, role_id, api_url, debug=False):
-    """Create a user in Auth0 and assign a role."""
-    headers = {
-        "Authorization": f"Bearer {auth0_token}",
-        "Content-Type": "application/json"
-    }
-    
-    # Create user
-    user_url = f"{api_url}users"
-    user_data = {
-        "email": email,
-        "connection": "Username-Password-Authentication",
-        "password": "Temp1234!",  # Temporary password
-        "email_verified": True
-    }
+def make_user_creator(client, debug=False):
+    """Return a coroutine function that creates the Auth0 user for an email.
     
+    Everything that is fixed for the run is bound here once, so each call
+    only builds the payload for its email and sends it.
+    """
     if debug:
-        print("\n=== DEBUG: User Creation Request ===")
-        print(f"URL: {user_url}")
-        print(f"Headers: {json.dumps(headers, indent=2)}")
-        print(f"Payload: {json.dumps(user_data, indent=2)}")
-        # Mock a successful response for debug mode
-        mock_user_id = f"auth0|debug-{email.replace('@', '-at-')}"
-        mock_response = {
-            "user_id": mock_user_id,
-            "email": email,
-            "email_verified": True,
-            "created_at": "2023-01-01T00:00:00.000Z",
-            "updated_at": "2023-01-01T00:00:00.000Z",
-            "identities": [
-                {
-                    "connection": "Username-Password-Authentication",
-                    "user_id": mock_user_id.split("|")[1],
-                    "provider": "auth0",
-                    "isSocial": False
-                }
-            ]
-        }
-        print(f"Mock Response: {json.dumps(mock_response, indent=2)}")
-        user_id = mock_user_id
-    else:
-        user_response = requests.post(user_url, headers=headers, json=user_data)
+        base_url = client.base_url
         
-        if user_response.status_code != 201:
+        async def create_user(email):
+            user_data = {**STATIC_USER_DATA, "email": email}
+            logger.debug("\n=== DEBUG: User Creation Request ===")
+            logger.debug("URL: %susers", base_url)
+            logger.debug("Payload: %s", orjson.dumps(user_data, option=orjson.OPT_INDENT_2).decode())
+            # Mock a successful response for debug mode
+            identity_id = "debug-" + email.replace("@", "-at-")
+            mock_response = {
+                "user_id": "auth0|" + identity_id,
+                "email": email,
+                **MOCK_USER_FIELDS,
+                "identities": [
+                    {"connection": USER_CONNECTION, "user_id": identity_id, **MOCK_IDENTITY_FIELDS}
+                ]
+            }
+            logger.debug("Mock Response: %s", orjson.dumps(mock_response, option=orjson.OPT_INDENT_2).decode())
             return {
-                "success": False,
-                "error": f"Failed to create user: {user_response.text}",
-                "status_code": user_response.status_code
+                "success": True,
+                "user": mock_response,
+                "debug_mode": True
+            }
+    else:
+        async def create_user(email):
+            # Retrying after the body may have been processed could create the user
+            # twice, or fail with a 409 while the first attempt succeeded
+            try:
+                user_response = await send_with_retry(
+                    client, "POST", "users", idempotent=False,
+                    content=orjson.dumps({**STATIC_USER_DATA, "email": email})
+                )
+            except httpx.TransportError as e:
+                return {
+                    "success": False,
+                    "error": f"Request failed, the user may have been created anyway: {type(e).__name__}: {str(e)}"
+                }
+            
+            if user_response.status_code != 201:
+                return {
+                    "success": False,
+                    "error": describe_failure("create user", user_response, idempotent=False),
+                    "status_code": user_response.status_code
+                }
+            
+            return {
+                "success": True,
+                "user": orjson.loads(user_response.content)
             }
-        
-        user_id = user_response.json()["user_id"]
     
-    # Assign role to user
-    role_url = f"{api_url}users/{user_id}/roles"
-    role_data = {"roles": [role_id]}
+    return create_user
+
+
+def make_role_assigner(client, role_id, debug=False):
+    """Return a coroutine function that assigns role_id to a list of user ids.
+    
+    Each call sends at most ROLE_ASSIGNMENT_CHUNK_SIZE users in one request.
+    """
+    role_path = "roles/" + role_id + "/users"
     
     if debug:
-        print("\n=== DEBUG: Role Assignment Request ===")
-        print(f"URL: {role_url}")
-        print(f"Headers: {json.dumps(headers, indent=2)}")
-        print(f"Payload: {json.dumps(role_data, indent=2)}")
-        print("Mock Response: No content (204)")
-        return {
-            "success": True,
-            "user": mock_response if debug else user_response.json(),
-            "role_assigned": True,
-            "debug_mode": True
-        }
+        role_url = f"{client.base_url}{role_path}"
+        
+        async def assign_role(user_ids):
+            logger.debug("\n=== DEBUG: Role Assignment Request ===")
+            logger.debug("URL: %s", role_url)
+            logger.debug("Payload: %s", orjson.dumps({"users": user_ids}, option=orjson.OPT_INDENT_2).decode())
+            logger.debug("Mock Response: OK (200)")
+            return {"success": True}
     else:
-        role_response = requests.post(role_url, headers=headers, json=role_data)
+        async def assign_role(user_ids):
+            role_response = await send_with_retry(
+                client, "POST", role_path, content=orjson.dumps({"users": user_ids})
+            )
+            
+            if role_response.status_code != 200:
+                return {
+                    "success": False,
+                    "error": describe_failure("assign role", role_response),
+                    "status_code": role_response.status_code
+                }
+            
+            return {"success": True}
+    
+    return assign_role
+
+
+def make_email_formatter(template):
+    """Return a function that builds the email for a given number."""
+    if any(match.group("fmt") for match in TEMPLATE_RE.finditer(template)):
+        def format_email(num):
+            return TEMPLATE_RE.sub(lambda match: format(num, match.group("fmt") or ""), template)
+    else:
+        # Fast path for plain {$} placeholders: split once, join per number
+        parts = template.split("{$}")
         
-        if role_response.status_code != 204:
-            return {
-                "success": False,
-                "error": f"Failed to assign role: {role_response.text}",
-                "user_created": user_response.json(),
-                "status_code": role_response.status_code
-            }
+        def format_email(num):
+            return str(num).join(parts)
     
-        return {
-            "success": True,
-            "user": user_response.json(),
-            "role_assigned": True
-        }
+    return format_email
 
 
-def save_results(results, output_file):
-    """Save results to the output file, appending if possible."""
-    existing_data = []
+def is_json_document_start(first_line):
+    """Tell whether a file's first line starts a JSON document rather than NDJSON.
     
-    # Check if file exists and try to read existing content
-    if os.path.exists(output_file):
-        try:
-            with open(output_file, 'r') as f:
-                existing_data = json.load(f)
-                if not isinstance(existing_data, list):
-                    print(f"Warning: Existing file {output_file} does not contain a valid JSON array. Overwriting.")
-                    existing_data = []
-        except json.JSONDecodeError:
-            print(f"Warning: Existing file {output_file} does not contain valid JSON. Overwriting.")
-        except Exception as e:
-            print(f"Warning: Error reading existing file {output_file}: {str(e)}. Overwriting.")
-    
-    # Combine existing data with new results
-    if isinstance(existing_data, list):
-        combined_data = existing_data + results
-    else:
-        combined_data = results
+    NDJSON lines are complete JSON values on their own; a JSON array, or a
+    pretty-printed object, only parses once the rest of the file is read.
+    """
+    if first_line.lstrip().startswith(b"["):
+        return True
+    try:
+        orjson.loads(first_line)
+    except orjson.JSONDecodeError:
+        return True
+    return False
+
+
+def merge_results(input_files, output_file):
+    """Append the results of earlier runs to the output file as NDJSON.
     
-    # Write the combined data
-    with open(output_file, 'w') as f:
-        json.dump(combined_data, f, indent=2)
+    Input files may be NDJSON or the JSON arrays written by older versions.
+    Returns the number of results written.
+    """
+    total_written = 0
     
-    if len(existing_data) > 0:
-        print(f"Appended {len(results)} new results to existing {len(existing_data)} results in {output_file}")
-    else:
-        print(f"Saved {len(results)} results to {output_file}")
+    with open(output_file, "ab") as out_fp:
+        for input_file in input_files:
+            if os.path.abspath(input_file) == os.path.abspath(output_file):
+                print(f"Warning: Skipping {input_file}, it is the output file")
+                continue
+            
+            written = 0
+            complete = True
+            try:
+                with open(input_file, "rb") as f:
+                    first_line = f.readline()
+                    if is_json_document_start(first_line):
+                        # Legacy output is a single JSON array and is parsed as a whole
+                        results = orjson.loads(first_line + f.read())
+                        if not isinstance(results, list):
+                            print(f"Warning: {input_file} does not contain a valid JSON array. Skipping.")
+                            continue
+                    else:
+                        lines = itertools.chain([first_line], f)
+                        results = (orjson.loads(line) for line in lines if line.strip())
+                    
+                    for result in results:
+                        # Every result written by this script holds the created user
+                        if not isinstance(result, dict) or "user" not in result:
+                            print(f"Warning: {input_file} contains an entry that is not a user result. Skipping the rest.")
+                            complete = False
+                            break
+                        out_fp.write(orjson.dumps(result) + b"\n")
+                        written += 1
+            except orjson.JSONDecodeError as e:
+                print(f"Warning: {input_file} contains invalid JSON after {written} results: {str(e)}. Skipping the rest.")
+            except OSError as e:
+                print(f"Warning: Error reading file {input_file}: {str(e)}. Skipping.")
+            else:
+                if complete:
+                    print(f"Merged {written} results from {input_file} into {output_file}")
+            
+            total_written += written
     
-    return len(combined_data)
+    return total_written
 
 
 def main():
     parser = argparse.ArgumentParser(description="Create Auth0 users with incremental emails")
-    parser.add_argument("--token", required=True, help="Auth0 Management API token")
-    parser.add_argument("--email", required=True, help="Email template with {$} placeholder")
-    parser.add_argument("--start", type=int, required=True, help="Starting number for email replacement")
-    parser.add_argument("--end", type=int, required=True, help="Ending number for email replacement")
+    parser.add_argument("--token", help="Auth0 Management API token")
+    parser.add_argument("--email", help="Email template with {$} placeholder, optionally with a format spec like {$:04d}")
+    parser.add_argument("--start", type=int, help="Starting number for email replacement")
+    parser.add_argument("--end", type=int, help="Ending number for email replacement")
     parser.add_argument("--role-id", help="Role ID to assign to users (optional, will prompt if not provided)")
-    parser.add_argument("--output", default="auth0_users.json", help="Output file for successful responses")
+    parser.add_argument("--output", default="auth0_users.jsonl", help="Output file for successful responses, appended as one JSON object per line")
     parser.add_argument("--debug", action="store_true", help="Run in debug mode without making actual API calls")
+    parser.add_argument("--verbose", action="store_true", help="Log every created user instead of only showing a progress bar")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of users to create in parallel (default: 16)")
+    parser.add_argument("--role-concurrency", type=int, default=4, help="Number of role assignment requests in parallel (default: 4)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of users submitted per batch (default: 1000)")
+    parser.add_argument("--merge", nargs="+", metavar="FILE", help="Append results from earlier output files (JSON array or NDJSON) to --output and exit")
     
     args = parser.parse_args()
     
+    if args.merge:
+        total_written = merge_results(args.merge, args.output)
+        print(f"Merged {total_written} results into {args.output}")
+        return
+    
+    # These are only optional when merging files
+    missing = [flag for flag in ("--token", "--email", "--start", "--end")
+               if getattr(args, flag[2:]) is None]
+    if missing:
+        parser.error(f"the following arguments are required: {', '.join(missing)}")
+    
     if args.debug:
         print("=== RUNNING IN DEBUG MODE - NO ACTUAL API CALLS WILL BE MADE ===")
     
@@ -240,53 +466,211 @@ def main():
     api_url = extract_api_url_from_token(args.token)
     print(f"API URL extracted from token: {api_url}")
     
-    if "{$}" not in args.email:
+    if not TEMPLATE_RE.search(args.email):
         print("Error: Email template must contain {$} placeholder")
         sys.exit(1)
     
+    format_email = make_email_formatter(args.email)
+    try:
+        format_email(args.start)
+    except ValueError as e:
+        print(f"Error: Invalid format spec in email template: {str(e)}")
+        sys.exit(1)
+    
     if args.start > args.end:
         print("Error: Start number must be less than or equal to end number")
         sys.exit(1)
     
-    # Get role ID - either from command line or by fetching and prompting
-    role_id = args.role_id
-    if not role_id:
-        roles = get_roles(args.token, api_url, args.debug)
-        role_id = prompt_role_selection(roles)
-    
-    results = []
+    if args.concurrency < 1 or args.role_concurrency < 1 or args.batch_size < 1:
+        print("Error: Concurrency and batch size must be at least 1")
+        sys.exit(1)
     
+    listener = setup_logging(args.verbose, args.debug)
     try:
-        for num in range(args.start, args.end + 1):
-            email = args.email.replace("{$}", str(num))
-            print(f"Creating user with email: {email}")
-            
-            response = create_user(args.token, email, role_id, api_url, args.debug)
+        created, failed = asyncio.run(run(args, api_url, format_email))
+    finally:
+        # Flush pending log records before the summary is printed
+        listener.stop()
+    
+    if created:
+        print(f"Saved {created} results to {args.output}")
+    
+    if failed:
+        sys.exit(1)
+    
+    print(f"Successfully created {created} users.")
+    if args.debug:
+        print("\nNOTE: Since this was run in debug mode, no actual users were created.")
+
+
+async def run(args, api_url, format_email):
+    """Create all users and assign them the role in a two-stage pipeline.
+    
+    Returns the number of users written to the output file and whether
+    any of them failed.
+    """
+    async with make_client(args.token, api_url) as client:
+        # Get role ID - either from command line or by fetching and prompting
+        role_id = args.role_id
+        if not role_id:
+            roles = await get_roles(client, args.debug)
+            role_id = prompt_role_selection(roles)
+        
+        if args.debug:
+            # The headers are the same for every request, so show them only once
+            logger.debug("\n=== DEBUG: Request Headers ===")
+            logger.debug("%s", orjson.dumps(dict(client.headers), option=orjson.OPT_INDENT_2).decode())
+        
+        create_user = make_user_creator(client, args.debug)
+        assign_role = make_role_assigner(client, role_id, args.debug)
+        
+        # Users flow from the creation stage to the role stage through a bounded
+        # queue, so both stages run at the same time and each has its own limit
+        create_sem = asyncio.Semaphore(args.concurrency)
+        role_sem = asyncio.Semaphore(args.role_concurrency)
+        user_queue = asyncio.Queue(maxsize=USER_QUEUE_SIZE)
+        created = 0
+        failed = False
+        role_stage_stopped = False
+        
+        def report_exceptions(results):
+            nonlocal failed
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Unexpected error: %s: %s", type(result).__name__, result)
+                    failed = True
+        
+        async def create_bounded(email):
+            nonlocal failed
+            async with create_sem:
+                # Users still waiting for a slot are not created once anything failed
+                if failed:
+                    return
+                logger.info("Creating user with email: %s", email)
+                response = await create_user(email)
             
             if response["success"]:
                 user_id = response["user"]["user_id"]
-                print(f"  ✓ User created successfully with ID: {user_id}")
-                results.append(response)
+                logger.info("  ✓ User created successfully with ID: %s", user_id)
+                if role_stage_stopped:
+                    # Nothing reads the queue any more; keep the user without the role
+                    write_results([response], ROLE_STAGE_STOPPED_ERROR)
+                else:
+                    await user_queue.put(response)
             else:
-                print(f"  ✗ Error: {response['error']}")
-                # Save successful results before exiting
-                if results:
-                    total_saved = save_results(results, args.output)
-                sys.exit(1)
+                logger.error("  ✗ Error for %s: %s", email, response["error"])
+                failed = True
         
-        # Save all successful results
-        if results:
-            total_saved = save_results(results, args.output)
-            print(f"Successfully created {len(results)} users. Total users in output file: {total_saved}")
-            if args.debug:
-                print("\nNOTE: Since this was run in debug mode, no actual users were created.")
+        async def produce_users():
+            try:
+                numbers = range(args.start, args.end + 1)
+                # Schedule in batches so the pending tasks stay bounded on large ranges
+                for batch_start in range(0, len(numbers), args.batch_size):
+                    emails = [
+                        format_email(num)
+                        for num in numbers[batch_start:batch_start + args.batch_size]
+                    ]
+                    report_exceptions(await asyncio.gather(
+                        *(create_bounded(email) for email in emails),
+                        return_exceptions=True
+                    ))
+                    
+                    # Stop scheduling new batches once a user has failed
+                    if failed:
+                        break
+            finally:
+                # Tell the role stage that no more users are coming
+                await user_queue.put(None)
         
-    except Exception as e:
-        print(f"Unexpected error: {str(e)}")
-        # Save successful results before exiting
-        if results:
-            save_results(results, args.output)
-        sys.exit(1)
+        def write_results(responses, role_error=None):
+            nonlocal created
+            for response in responses:
+                # Users whose role assignment failed are kept too, so they can be fixed later
+                response["role_assigned"] = role_error is None
+                if role_error is not None:
+                    response["role_error"] = role_error
+                # Stream each result to disk so nothing is lost if the run stops
+                out_fp.write(orjson.dumps(response) + b"\n")
+            created += len(responses)
+            progress.update(len(responses))
+        
+        async def assign_bounded(responses):
+            nonlocal failed
+            user_ids = [response["user"]["user_id"] for response in responses]
+            try:
+                role_response = await assign_role(user_ids)
+            except Exception as e:
+                role_response = {"success": False, "error": f"{type(e).__name__}: {str(e)}"}
+            finally:
+                role_sem.release()
+            
+            if role_response["success"]:
+                logger.info("  ✓ Role assigned to %d users", len(user_ids))
+                write_results(responses)
+            else:
+                logger.error("  ✗ Error for %s: %s", ", ".join(user_ids), role_response["error"])
+                write_results(responses, role_response["error"])
+                failed = True
+        
+        async def consume_users():
+            nonlocal failed, role_stage_stopped
+            loop = asyncio.get_running_loop()
+            pending = set()
+            finished = False
+            
+            try:
+                while not finished:
+                    response = await user_queue.get()
+                    if response is None:
+                        break
+                    
+                    # Collect a full chunk, or whatever arrives within ROLE_ASSIGNMENT_WAIT
+                    chunk = [response]
+                    deadline = loop.time() + ROLE_ASSIGNMENT_WAIT
+                    while len(chunk) < ROLE_ASSIGNMENT_CHUNK_SIZE:
+                        try:
+                            response = await asyncio.wait_for(user_queue.get(), deadline - loop.time())
+                        except asyncio.TimeoutError:
+                            break
+                        if response is None:
+                            finished = True
+                            break
+                        chunk.append(response)
+                    
+                    # Waiting for a free slot here lets the queue fill up and slow
+                    # down the creation stage when role assignment falls behind
+                    await role_sem.acquire()
+                    task = asyncio.ensure_future(assign_bounded(chunk))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            except Exception:
+                failed = True
+                role_stage_stopped = True
+                # Keep the queue moving so producers blocked on put() can finish,
+                # recording what they created, until the producer signals the end
+                response = await user_queue.get()
+                while response is not None:
+                    write_results([response], ROLE_STAGE_STOPPED_ERROR)
+                    response = await user_queue.get()
+                raise
+            finally:
+                report_exceptions(await asyncio.gather(*pending, return_exceptions=True))
+        
+        # The progress bar redraws at most 10 times per second; it replaces
+        # the per-user messages unless --verbose or --debug is given
+        progress = tqdm(
+            total=args.end - args.start + 1,
+            unit="user",
+            mininterval=0.1,
+            disable=True if args.verbose or args.debug else None
+        )
+        # Results are appended as NDJSON, so earlier runs are never re-read or rewritten
+        with progress, open(args.output, "ab", buffering=1 << 16) as out_fp:
+            report_exceptions(await asyncio.gather(
+                produce_users(), consume_users(), return_exceptions=True
+            ))
+        
+        return created, failed
 
 
 if __name__ == "__main__":